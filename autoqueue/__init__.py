@@ -190,6 +190,7 @@ class Cache(object):
         self.running = False
         self.last_songs = []
         self.last_song = None
+        self.gaia_neighbours = {}
         self.nearby_artists = []
         self.weather = None
         self.weather_at = None
@@ -339,6 +340,7 @@ class AutoQueueBase(object):
         """Queue a single track."""
         self.cache.running = True
         self.cache.last_songs = self.get_last_songs()
+        self.cache.gaia_neighbours = {}
         song = self.cache.last_song = self.cache.last_songs.pop()
         self.analyze_and_callback(
             song.get_filename(), reply_handler=self.analyzed,
@@ -347,10 +349,7 @@ class AutoQueueBase(object):
     def get_best_request(self, filename):
         all_requests = self.requests.get_requests()
         if not all_requests:
-            self.similarity.get_ordered_gaia_tracks(
-                filename, self.configuration.number,
-                reply_handler=self.gaia_reply_handler,
-                error_handler=self.error_handler, timeout=TIMEOUT)
+            self.get_gaia_tracks(filename)
         elif len(all_requests) == 1:
             self.best_request_handler(all_requests[0])
         else:
@@ -377,10 +376,32 @@ class AutoQueueBase(object):
 
         else:
             print("***** no requests")
-        self.similarity.get_ordered_gaia_tracks(
-            filename, self.configuration.number,
-            reply_handler=self.gaia_reply_handler,
-            error_handler=self.error_handler, timeout=TIMEOUT)
+        self.get_gaia_tracks(filename)
+
+    def get_gaia_tracks(self, filename):
+        """Get similar tracks for filename.
+
+        Neighbours for the songs that will be tried after it are fetched in
+        the same call, so falling back to them needs no more round trips.
+
+        """
+        if filename in self.cache.gaia_neighbours:
+            self.gaia_reply_handler(self.cache.gaia_neighbours.pop(filename))
+            return
+
+        filenames = [filename] + [
+            ensure_string(song.get_filename())
+            for song in reversed(self.cache.last_songs)]
+        filenames = [name for name in filenames if name]
+
+        def reply_handler(results):
+            self.cache.gaia_neighbours = dict(zip(filenames, results))
+            self.gaia_reply_handler(self.cache.gaia_neighbours.pop(filename))
+
+        self.similarity.get_ordered_gaia_tracks_batch(
+            filenames, self.configuration.number,
+            reply_handler=reply_handler, error_handler=self.error_handler,
+            timeout=TIMEOUT)
 
     def analyzed(self):
         song = self.cache.last_song
@@ -422,10 +443,7 @@ class AutoQueueBase(object):
             if not filename:
                 return
             self.current_request = None
-            self.similarity.get_ordered_gaia_tracks(
-                filename, self.configuration.number,
-                reply_handler=self.gaia_reply_handler,
-                error_handler=self.error_handler, timeout=TIMEOUT)
+            self.get_gaia_tracks(filename)
             return
         self.get_similar_tracks()
 
@@ -509,6 +527,9 @@ class AutoQueueBase(object):
             self.cache.running = False
             return
         song = self.cache.last_song = self.cache.last_songs.pop()
+        if ensure_string(song.get_filename()) in self.cache.gaia_neighbours:
+            self.analyzed()
+            return
         self.analyze_and_callback(
             song.get_filename(), reply_handler=self.analyzed,
             empty_handler=self.gaia_reply_handler)
@@ -0,0 +1,154 @@
+"""Analyze a music library in bulk through the similarity service."""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import sys
+from builtins import object, range
+from multiprocessing import cpu_count
+from time import time
+
+import dbus
+
+from autoqueue.excerpts import PROFILES
+from autoqueue.utilities import player_get_data_dir
+
+AUDIO_EXTENSIONS = (
+    '.ape', '.flac', '.m4a', '.mp3', '.mp4', '.mpc', '.oga', '.ogg',
+    '.opus', '.wav', '.wma', '.wv')
+# Files sent to the service per call, per worker. Every call waits for its
+# slowest file, so more files per call keep the workers busier.
+BATCH_FACTOR = 4
+# Seconds to wait for a single call.
+CALL_TIMEOUT = 24 * 60 * 60
+
+
+def find_audio_files(directory):
+    """Walk a directory tree in a stable order, yielding audio files."""
+    for root, directories, files in os.walk(directory):
+        directories.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS:
+                yield os.path.join(root, name)
+
+
+def format_duration(seconds):
+    """Format seconds as hours:minutes:seconds."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Checkpoint(object):
+
+    """Files handled so far, appended to a file as they are done."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as checkpoint:
+            for line in checkpoint:
+                try:
+                    self.done.add(json.loads(line))
+                except ValueError:
+                    # Cut off by a crash while it was being written.
+                    continue
+
+    def add(self, filenames):
+        """Record files as done."""
+        with open(self.path, 'a') as checkpoint:
+            for filename in filenames:
+                checkpoint.write(json.dumps(filename) + '\n')
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        self.done.update(filenames)
+
+
+def get_similarity():
+    """Get the similarity service over D-Bus."""
+    bus = dbus.SessionBus()
+    sim = bus.get_object('org.autoqueue', '/org/autoqueue/Similarity')
+    return dbus.Interface(
+        sim, dbus_interface='org.autoqueue.SimilarityInterface')
+
+
+def analyze(similarity, filenames, checkpoint, workers, profile=None):
+    """Analyze files in batches, reporting progress after each."""
+    similarity.set_analysis_workers(workers)
+    if profile is not None and not similarity.set_analysis_profile(profile):
+        print("the service can not use the %s profile" % profile)
+        return len(filenames)
+    batch = workers * BATCH_FACTOR
+    failed = 0
+    start_time = time()
+    for start in range(0, len(filenames), batch):
+        chunk = filenames[start:start + batch]
+        analyzed = similarity.analyze_tracks_and_wait(
+            chunk, timeout=CALL_TIMEOUT)
+        failed += len(chunk) - len(analyzed)
+        # Failed files are tried again the next time.
+        checkpoint.add([str(filename) for filename in analyzed])
+        done = start + len(chunk)
+        rate = done / (time() - start_time)
+        print("%d/%d files, %d failed, %.1f files/min, ETA %s" % (
+            done, len(filenames), failed, rate * 60,
+            format_duration((len(filenames) - done) / rate)))
+    return failed
+
+
+def reconcile(similarity, directory, filenames):
+    """Remove analyzed tracks under directory that are gone, and report."""
+    if similarity.get_readiness() != 'ready':
+        print("the similarity service has not finished loading, try again "
+              "later")
+        return 1
+    removed, unanalyzed = similarity.reconcile(
+        filenames, directory, timeout=CALL_TIMEOUT)
+    for filename in removed:
+        print("removed %s" % filename)
+    print("%d tracks removed, %d audio files not analyzed yet" % (
+        len(removed), unanalyzed))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Analyze all audio files under a directory. Progress "
+        "is checkpointed, running it again resumes where it stopped.")
+    parser.add_argument('directory')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=cpu_count(),
+        help="number of extractors to run at the same time")
+    parser.add_argument(
+        '-p', '--profile', choices=PROFILES,
+        help="analyze long tracks in full or from excerpts")
+    parser.add_argument(
+        '-c', '--checkpoint',
+        default=os.path.join(player_get_data_dir(), 'analyze.checkpoint'),
+        help="file to record progress in")
+    parser.add_argument(
+        '-r', '--reconcile', action='store_true',
+        help="instead of analyzing, remove the analysis of tracks under the "
+        "directory that no longer exist")
+    args = parser.parse_args(argv)
+    directory = os.path.abspath(args.directory)
+    found = list(find_audio_files(directory))
+    if args.reconcile:
+        return reconcile(get_similarity(), directory, found)
+    checkpoint = Checkpoint(args.checkpoint)
+    filenames = [
+        filename for filename in found if filename not in checkpoint.done]
+    print("%d audio files, %d done before" % (
+        len(found), len(found) - len(filenames)))
+    if not filenames:
+        return 0
+    failed = analyze(
+        get_similarity(), filenames, checkpoint, args.workers, args.profile)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
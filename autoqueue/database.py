@@ -0,0 +1,131 @@
+"""SQLite access with a pool of readers and a single writer thread."""
+from __future__ import absolute_import, print_function
+
+import sqlite3
+from builtins import object, range
+from itertools import count
+from queue import Empty, PriorityQueue, Queue
+from threading import Thread
+from time import time
+
+# Read-only connections, each serving one query at a time.
+READERS = 4
+# Commit once this many statements are pending, or this many seconds
+# after the first of them, whichever comes first.
+COMMIT_SIZE = 1000
+COMMIT_INTERVAL = 1.0
+# Priority of flushes and consistent reads, which go after all writes
+# queued before them.
+LAST = float('inf')
+
+
+class SQLCommand(object):
+
+    """A SQL command object."""
+
+    def __init__(self, sql_statements, flush=False):
+        self.sql = sql_statements
+        self.flush = flush
+        self.result_queue = Queue()
+
+
+class Database(object):
+
+    """SQLite database in WAL mode, so that reads and writes don't block.
+
+    SELECTs run on the calling thread, on one of a pool of read-only
+    connections, and only wait when all of them are busy. All other
+    statements are queued by priority for a single writer thread, which
+    groups them into transactions: it commits every COMMIT_SIZE
+    statements, COMMIT_INTERVAL seconds after the first uncommitted one,
+    and when asked to flush. Until then the changes are only visible to
+    consistent reads, which run on the writer connection.
+
+    """
+
+    def __init__(self, path, readers=READERS):
+        self.path = path
+        self.queue = PriorityQueue()
+        self.counter = count()
+        self.commits = 0
+        self.writer = sqlite3.connect(
+            path, isolation_level='immediate', check_same_thread=False)
+        self.writer.execute('PRAGMA journal_mode = WAL;')
+        self.writer.execute('PRAGMA synchronous = NORMAL;')
+        self.readers = Queue()
+        for _ in range(readers):
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute('PRAGMA query_only = ON;')
+            self.readers.put(connection)
+        self.thread = Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def select(self, sql, consistent=False, priority=LAST):
+        """Run a (statement, parameters) query, get all rows.
+
+        A consistent read waits for the writes queued before it at the same
+        or a lower priority, and sees them whether they have been committed
+        or not. Writes queued at a higher priority may still be pending.
+
+        """
+        if consistent:
+            return self.execute(sql, priority=priority).result_queue.get()
+        connection = self.readers.get()
+        try:
+            return connection.execute(*sql).fetchall()
+        except Exception as e:
+            print(e, repr(sql))
+            return []
+        finally:
+            self.readers.put(connection)
+
+    def execute(self, sql, priority=1):
+        """Queue a (statement, parameters) change for the writer.
+
+        Lower priorities go first. Returns the command, to wait on its
+        result queue.
+
+        """
+        return self._put(SQLCommand(sql), priority)
+
+    def flush(self):
+        """Commit all writes queued so far, and wait until that is done."""
+        self._put(SQLCommand(None, flush=True), LAST).result_queue.get()
+
+    def _put(self, command, priority):
+        self.queue.put((priority, next(self.counter), command))
+        return command
+
+    def _write(self):
+        print("STARTING DATABASE WRITER THREAD")
+        cursor = self.writer.cursor()
+        pending = 0
+        deadline = None
+        while True:
+            try:
+                _, _, command = self.queue.get(
+                    timeout=None if deadline is None else max(
+                        0, deadline - time()))
+            except Empty:
+                command = None
+            result = []
+            if command is not None and command.sql is not None:
+                try:
+                    cursor.execute(*command.sql)
+                    result = cursor.fetchall()
+                except Exception as e:
+                    print(e, repr(command.sql))
+                if self.writer.in_transaction:
+                    pending += 1
+                    if deadline is None:
+                        deadline = time() + COMMIT_INTERVAL
+            if deadline is not None and (
+                    command is None or command.flush or
+                    pending >= COMMIT_SIZE or time() >= deadline):
+                self.writer.commit()
+                self.commits += 1
+                pending = 0
+                deadline = None
+            if command is not None:
+                command.result_queue.put(result)
@@ -0,0 +1,228 @@
+"""SQLite store of the raw acoustic descriptors of analyzed tracks."""
+from __future__ import absolute_import, print_function
+
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+from builtins import object
+from threading import Lock
+from time import time
+
+# Bytes hashed at the start, middle and end of a file to identify it.
+SAMPLE_SIZE = 256 * 1024
+# Seconds the descriptors of removed tracks are kept, in case the same
+# file shows up under another name.
+REMOVED_LIFETIME = 30 * 24 * 60 * 60
+
+
+def track_identity(filename):
+    """Identify an audio file by its size and samples of its contents."""
+    size = os.path.getsize(filename)
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as audio:
+        for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+            audio.seek(max(0, offset))
+            digest.update(audio.read(SAMPLE_SIZE))
+    return '%d:%s' % (size, digest.hexdigest())
+
+
+def pack(values):
+    """Pack a list of numbers as float32."""
+    return sqlite3.Binary(struct.pack('<%df' % len(values), *values))
+
+
+def unpack(blob):
+    """Unpack float32 numbers."""
+    blob = bytes(blob)
+    return list(struct.unpack('<%df' % (len(blob) // 4), blob))
+
+
+class DescriptorStore(object):
+
+    """Descriptor vectors of analyzed tracks, one blob per track.
+
+    Every track has a layout: the list of (name, shape) of its descriptors,
+    stored once in a separate table, so that the vectors can be turned
+    back into descriptors or aligned with vectors of a different layout.
+    Tracks are keyed by filename and also carry the identity of the file's
+    contents and the analysis profile that produced them. The descriptors
+    of removed tracks are kept by identity for REMOVED_LIFETIME, so that
+    moved or renamed files can adopt them. Counting profiles goes through
+    a read-only connection of its own, so that status queries don't wait
+    for the writer.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS layouts (id INTEGER PRIMARY KEY, '
+            'layout TEXT, UNIQUE(layout));')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS descriptors (filename TEXT PRIMARY '
+            'KEY, identity TEXT, layout INTEGER, vector BLOB, profile TEXT);')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS descriptors_identity ON descriptors '
+            '(identity);')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS removed (identity TEXT PRIMARY KEY, '
+            'layout INTEGER, vector BLOB, removed REAL, profile TEXT);')
+        for table in ('descriptors', 'removed'):
+            self._add_column(table, 'profile', 'TEXT')
+        self.connection.commit()
+        self.layouts = {}
+        for layout_id, layout in self.connection.execute(
+                'SELECT id, layout FROM layouts;'):
+            self.layouts[layout_id] = [tuple(item) for item in json.loads(
+                layout)]
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute('PRAGMA query_only = ON;')
+        self.reader_lock = Lock()
+
+    def _add_column(self, table, column, kind):
+        """Add a column stores made by older versions don't have."""
+        columns = [
+            row[1] for row in self.connection.execute(
+                'PRAGMA table_info(%s);' % table)]
+        if column not in columns:
+            self.connection.execute(
+                'ALTER TABLE %s ADD COLUMN %s %s;' % (table, column, kind))
+
+    def __len__(self):
+        for row in self.connection.execute(
+                'SELECT COUNT(*) FROM descriptors;'):
+            return row[0]
+
+    def __contains__(self, filename):
+        for _ in self.connection.execute(
+                'SELECT 1 FROM descriptors WHERE filename = ?;', (filename,)):
+            return True
+        return False
+
+    def _layout_id(self, layout):
+        for layout_id, known in self.layouts.items():
+            if known == layout:
+                return layout_id
+        cursor = self.connection.execute(
+            'INSERT INTO layouts (layout) VALUES (?);',
+            (json.dumps(layout),))
+        self.layouts[cursor.lastrowid] = layout
+        return cursor.lastrowid
+
+    def add(self, identity, filename, descriptors, profile):
+        """Store (name, shape, values) descriptors for a track."""
+        layout = [(name, shape) for name, shape, _ in descriptors]
+        values = [value for _, _, numbers in descriptors for value in numbers]
+        self.connection.execute(
+            'INSERT OR REPLACE INTO descriptors (filename, identity, layout, '
+            'vector, profile) VALUES (?, ?, ?, ?, ?);',
+            (filename, identity, self._layout_id(layout), pack(values),
+             profile))
+
+    def remove(self, filename):
+        """Move the descriptors of a track to the removed tracks."""
+        now = time()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO removed (identity, layout, vector, '
+            'removed, profile) SELECT identity, layout, vector, ?, profile '
+            'FROM descriptors WHERE filename = ? AND identity IS NOT NULL;',
+            (now, filename))
+        self.connection.execute(
+            'DELETE FROM descriptors WHERE filename = ?;', (filename,))
+        self.connection.execute(
+            'DELETE FROM removed WHERE removed < ?;',
+            (now - REMOVED_LIFETIME,))
+
+    def adopt(self, identity, filename):
+        """Store the descriptors of a track with the same contents.
+
+        Returns the (name, shape, values) descriptors and the filename they
+        were found under, which is None for removed tracks, or None if no
+        track has this identity.
+
+        """
+        for previous, layout_id, blob, profile in self.connection.execute(
+                'SELECT filename, layout, vector, profile FROM descriptors '
+                'WHERE identity = ? LIMIT 1;', (identity,)):
+            break
+        else:
+            previous = None
+            for layout_id, blob, profile in self.connection.execute(
+                    'SELECT layout, vector, profile FROM removed WHERE '
+                    'identity = ?;', (identity,)):
+                break
+            else:
+                return None
+            self.connection.execute(
+                'DELETE FROM removed WHERE identity = ?;', (identity,))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO descriptors (filename, identity, layout, '
+            'vector, profile) VALUES (?, ?, ?, ?, ?);',
+            (filename, identity, layout_id, blob, profile))
+        return self.to_descriptors(layout_id, unpack(blob)), previous
+
+    def get(self, filename):
+        """Get the (name, shape, values) descriptors of a track."""
+        for layout_id, blob in self.connection.execute(
+                'SELECT layout, vector FROM descriptors WHERE filename = ?;',
+                (filename,)):
+            return self.to_descriptors(layout_id, unpack(blob))
+
+    def to_descriptors(self, layout_id, values):
+        """Split a vector up into (name, shape, values) descriptors."""
+        descriptors = []
+        offset = 0
+        for name, shape in self.layouts[layout_id]:
+            size = 1
+            for dimension in shape:
+                size *= dimension
+            descriptors.append(
+                (name, list(shape), values[offset:offset + size]))
+            offset += size
+        return descriptors
+
+    def profiles(self):
+        """Count committed tracks by analysis profile."""
+        with self.reader_lock:
+            return dict(self.reader.execute(
+                'SELECT profile, COUNT(*) FROM descriptors GROUP BY '
+                'profile;'))
+
+    def filenames(self):
+        """Get the filenames of all stored tracks."""
+        return [
+            row[0] for row in self.connection.execute(
+                'SELECT filename FROM descriptors;')]
+
+    def common_layout(self):
+        """Get the id of the layout most tracks have."""
+        for row in self.connection.execute(
+                'SELECT layout, COUNT(*) AS tracks FROM descriptors GROUP BY '
+                'layout ORDER BY tracks DESC LIMIT 1;'):
+            return row[0]
+
+    def iterate(self, sample=None):
+        """Yield (filename, layout id, blob) for all or a random sample."""
+        if sample is None:
+            cursor = self.connection.execute(
+                'SELECT filename, layout, vector FROM descriptors;')
+        else:
+            cursor = self.connection.execute(
+                'SELECT filename, layout, vector FROM descriptors WHERE '
+                'rowid IN (SELECT rowid FROM descriptors ORDER BY RANDOM() '
+                'LIMIT ?);',
+                (sample,))
+        for row in cursor:
+            yield row
+
+    def commit(self):
+        """Write pending changes to disk."""
+        self.connection.commit()
+
+    def close(self):
+        """Close the connections."""
+        self.reader.close()
+        self.connection.close()
@@ -0,0 +1,54 @@
+"""Pick excerpts of long audio files for the fast analysis profile."""
+from __future__ import absolute_import, division, print_function
+
+from builtins import range
+
+try:
+    import mutagen
+    MUTAGEN = True
+except ImportError:
+    MUTAGEN = False
+
+# Analysis profiles: the whole track, or a few excerpts of it.
+FULL = 'full'
+EXCERPT = 'excerpt'
+PROFILES = (FULL, EXCERPT)
+
+EXCERPTS = 3
+# Seconds per excerpt.
+EXCERPT_LENGTH = 30
+# Tracks shorter than this are always analyzed in full, the excerpts would
+# cover too much of them to make a difference.
+EXCERPT_MINIMUM_DURATION = 2 * EXCERPTS * EXCERPT_LENGTH
+
+
+def audio_duration(filename):
+    """Get the duration of an audio file in seconds, if it can be read."""
+    if not MUTAGEN:
+        return None
+    try:
+        audio = mutagen.File(filename)
+    except Exception as exc:
+        print(exc)
+        return None
+    if audio is None or audio.info is None:
+        return None
+    return audio.info.length
+
+
+def excerpt_ranges(duration, excerpts=EXCERPTS, length=EXCERPT_LENGTH):
+    """Get (start, end) seconds of excerpts spread evenly over a track."""
+    ranges = []
+    for number in range(excerpts):
+        middle = duration * (number + 1) / (excerpts + 1)
+        start = max(0, middle - length / 2)
+        ranges.append((start, min(duration, start + length)))
+    return ranges
+
+
+def get_excerpts(filename):
+    """Get the excerpts to analyze of a file, or None to analyze it all."""
+    duration = audio_duration(filename)
+    if duration is None or duration < EXCERPT_MINIMUM_DURATION:
+        return None
+    return excerpt_ranges(duration)
@@ -0,0 +1,181 @@
+"""Approximate nearest neighbour search with random projection trees."""
+from __future__ import absolute_import, division, print_function
+
+import random
+from builtins import object, range
+from heapq import heappop, heappush
+
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+from autoqueue.vectors import smallest
+
+TREES = 10
+LEAF_SIZE = 48
+# Candidates examined per tree and requested neighbour, by default. Raising
+# it trades latency for recall, queries can pass their own.
+SEARCH_FACTOR = 4
+
+
+class Node(object):
+
+    """Either a split by a hyperplane, or a leaf holding names."""
+
+    def __init__(self, names=None):
+        self.names = names
+        self.normal = None
+        self.offset = None
+        self.left = None
+        self.right = None
+
+    def margin(self, vector):
+        """Signed distance (up to scale) of vector to the hyperplane."""
+        return float(numpy.dot(self.normal, vector)) - self.offset
+
+
+class ProjectionForest(object):
+
+    """Forest of random projection trees over the rows of a VectorStore.
+
+    Leaves hold names rather than row numbers, since rows move around when
+    the store is compacted. Queries walk all trees best first until enough
+    candidates have been collected, and rank those exactly against the
+    VectorView they are given. They may run while the analysis thread adds
+    and removes names, so a leaf is only split once its children are in
+    place.
+
+    """
+
+    def __init__(self, vectors, trees=TREES, leaf_size=LEAF_SIZE,
+                 search_factor=SEARCH_FACTOR):
+        self.vectors = vectors
+        self.leaf_size = leaf_size
+        self.search_factor = search_factor
+        self.roots = []
+        self.leaves = {}
+        self.build(trees)
+
+    def build(self, trees):
+        """Build all trees from the current contents of the store."""
+        self.leaves = {}
+        names, block = self.vectors.snapshot()
+        self.roots = [
+            self._build_node(names, block, tree) for tree in range(trees)]
+
+    def _build_node(self, names, block, tree):
+        if len(names) <= self.leaf_size:
+            node = Node(set(names))
+            for name in names:
+                self.leaves.setdefault(name, {})[tree] = node
+            return node
+        node = Node()
+        sides = self._split(node, block)
+        left = numpy.flatnonzero(~sides)
+        right = numpy.flatnonzero(sides)
+        node.left = self._build_node(
+            [names[i] for i in left], block[left], tree)
+        node.right = self._build_node(
+            [names[i] for i in right], block[right], tree)
+        return node
+
+    @staticmethod
+    def _split(node, block):
+        """Pick a hyperplane between two random rows, return the sides."""
+        first, second = random.sample(range(len(block)), 2)
+        node.normal = block[first] - block[second]
+        node.offset = float(
+            numpy.dot(node.normal, (block[first] + block[second]) / 2))
+        sides = block.dot(node.normal) > node.offset
+        if sides.all() or not sides.any():
+            # Duplicate vectors: any split is as good as another.
+            sides = numpy.arange(len(block)) % 2 == 1
+            node.normal = numpy.zeros(block.shape[1], dtype=block.dtype)
+            node.offset = 0.0
+        return sides
+
+    def add(self, name):
+        """Insert a name whose vector has been added to the store."""
+        self.remove(name)
+        vector = self.vectors.vector(name)
+        for tree, root in enumerate(self.roots):
+            node = root
+            while node.names is None:
+                node = node.right if node.margin(vector) > 0 else node.left
+            node.names.add(name)
+            self.leaves.setdefault(name, {})[tree] = node
+            if len(node.names) > 2 * self.leaf_size:
+                self._split_leaf(node, tree)
+
+    def _split_leaf(self, node, tree):
+        names = list(node.names)
+        block = self.vectors.vectors(names)
+        sides = self._split(node, block)
+        node.left = Node(set(
+            name for name, side in zip(names, sides) if not side))
+        node.right = Node(set(
+            name for name, side in zip(names, sides) if side))
+        node.names = None
+        for child in (node.left, node.right):
+            for name in child.names:
+                self.leaves[name][tree] = child
+
+    def remove(self, name):
+        """Drop a name from all trees."""
+        for node in self.leaves.pop(name, {}).values():
+            node.names.discard(name)
+
+    def candidates(self, vector, number, search_factor=None):
+        """Collect names from the leaves closest to vector."""
+        wanted = number * len(self.roots) * (
+            search_factor or self.search_factor)
+        heap = []
+        for tree, root in enumerate(self.roots):
+            heappush(heap, (-float('inf'), tree, root))
+        found = set()
+        counter = len(self.roots)
+        while heap and len(found) < wanted:
+            priority, _, node = heappop(heap)
+            names = node.names
+            if names is not None:
+                found.update(list(names))
+                continue
+            margin = node.margin(vector)
+            priority = -priority
+            counter += 2
+            heappush(heap, (-min(priority, margin), counter, node.right))
+            heappush(heap, (-min(priority, -margin), counter + 1, node.left))
+        return found
+
+    def nearest(self, name, number, vectors, search_factor=None):
+        """Get (distance, name) for the approximate neighbours of a name.
+
+        Candidates missing from the VectorView `vectors` are left out.
+
+        """
+        vector = vectors.vector(name)
+        candidates = self.candidates(vector, number + 1, search_factor)
+        candidates.discard(name)
+        candidates = [
+            candidate for candidate in candidates if candidate in vectors]
+        if not candidates:
+            return []
+        distances = vectors.distances(vector, vectors.vectors(candidates))
+        return [
+            (float(distances[row]), candidates[row])
+            for row in smallest(distances, number)]
+
+    def recall(self, names, number, vectors, search_factor=None):
+        """Fraction of the exact neighbours that approximate search finds."""
+        found = expected = 0
+        for name in names:
+            exact = set(
+                neighbour for _, neighbour in vectors.nearest(name, number))
+            approximate = set(
+                neighbour for _, neighbour in self.nearest(
+                    name, number, vectors, search_factor))
+            found += len(exact & approximate)
+            expected += len(exact)
+        return found / expected if expected else 1.0
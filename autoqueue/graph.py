@@ -0,0 +1,333 @@
+"""Materialized nearest neighbour graph over the vector store."""
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+from builtins import object, range
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+from autoqueue.vectors import nearest_rows
+
+NEIGHBOURS = 50
+# Rows computed per matrix product when (re)building the graph.
+BLOCK_SIZE = 512
+MISSING = -1
+
+
+class NeighbourGraph(object):
+
+    """The K nearest neighbours of every row of a VectorStore.
+
+    Rows of the graph line up with rows of the store, holes included, and
+    neighbours are stored as row numbers, in two memory-mapped files: one
+    with row numbers and one with distances. A row whose first neighbour is
+    MISSING has not been computed yet, queries for it have to search on
+    the fly. Holes are always missing.
+
+    """
+
+    def __init__(self, vectors, path, neighbours=NEIGHBOURS):
+        self.vectors = vectors
+        self.path = path
+        self.distances_path = path + '.distances'
+        self.meta_path = path + '.json'
+        self.neighbours = neighbours
+        self.ids = None
+        self.distances = None
+        # Bumped by every reset, so that lists computed in the background
+        # from vectors that have been replaced since can be told apart.
+        self.generation = 0
+        self.load()
+
+    @property
+    def capacity(self):
+        """Number of rows the files on disk have room for."""
+        if self.ids is None:
+            return 0
+        return self.ids.shape[0]
+
+    def load(self):
+        """Map the graph files, or start over if they don't match the store.
+
+        """
+        try:
+            with open(self.meta_path, 'r') as meta:
+                data = json.load(meta)
+        except (IOError, OSError, ValueError):
+            data = {}
+        self._map()
+        if (data.get('neighbours') != self.neighbours or
+                data.get('rows') != self.vectors.used or
+                data.get('vectors') != self.vectors.generation or
+                self.capacity < self.vectors.used):
+            self.reset()
+            return
+        # Lists changed after the last flush can name rows the store has
+        # not written to its index.
+        size = self.vectors.used
+        if size:
+            self.ids[numpy.flatnonzero(
+                (self.ids[:size] >= size).any(axis=1)), 0] = MISSING
+
+    def _map(self):
+        rows = 0
+        if os.path.exists(self.path) and os.path.exists(self.distances_path):
+            rows = os.path.getsize(self.path) // (4 * self.neighbours)
+        if not rows:
+            self.ids = self.distances = None
+            return
+        shape = (rows, self.neighbours)
+        self.ids = numpy.memmap(
+            self.path, dtype=numpy.int32, mode='r+', shape=shape)
+        self.distances = numpy.memmap(
+            self.distances_path, dtype=numpy.float32, mode='r+', shape=shape)
+
+    def reset(self):
+        """Mark every row as missing."""
+        self.generation += 1
+        self.ids = self.distances = None
+        for path in (self.path, self.distances_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.ensure_capacity()
+
+    def ensure_capacity(self):
+        """Grow the files along with the vector store."""
+        capacity = max(self.vectors.capacity, self.vectors.used)
+        old = self.capacity
+        if old >= capacity:
+            return
+        for array in (self.ids, self.distances):
+            if array is not None:
+                array.flush()
+        self.ids = self.distances = None
+        for path in (self.path, self.distances_path):
+            with open(path, 'ab') as graph:
+                graph.truncate(capacity * 4 * self.neighbours)
+        self._map()
+        self.ids[old:] = MISSING
+        self.distances[old:] = numpy.inf
+
+    def flush(self):
+        """Write changes to disk."""
+        if self.ids is not None:
+            self.ids.flush()
+            self.distances.flush()
+        temporary = self.meta_path + '.tmp'
+        with open(temporary, 'w') as meta:
+            json.dump({
+                'neighbours': self.neighbours, 'rows': self.vectors.used,
+                'vectors': self.vectors.generation}, meta)
+        os.rename(temporary, self.meta_path)
+
+    def missing(self):
+        """Get the rows that still need to be computed."""
+        if self.ids is None:
+            return numpy.zeros(0, dtype=int)
+        names = self.vectors.names
+        return numpy.array([
+            row for row in numpy.flatnonzero(
+                self.ids[:len(names), 0] == MISSING)
+            if names[row] is not None], dtype=int)
+
+    def snapshot(self):
+        """Get what computing the missing rows takes.
+
+        Returns the names and a copy of the vectors of the live rows, and
+        the positions among them of the missing rows.
+
+        """
+        names, block = self.vectors.snapshot()
+        positions = {name: position for position, name in enumerate(names)}
+        rows = numpy.array([
+            positions[self.vectors.names[row]] for row in self.missing()],
+            dtype=int)
+        return names, block, rows
+
+    def view(self, vectors):
+        """Get a copy of the lists for queries against a VectorView."""
+        if self.ids is None:
+            return GraphView(vectors, None, None, self.neighbours)
+        size = len(vectors.names)
+        return GraphView(
+            vectors, numpy.array(self.ids[:size]),
+            numpy.array(self.distances[:size]), self.neighbours)
+
+    def add(self, name):
+        """Patch the graph for a name just added to the store.
+
+        The new row is left missing, but it is inserted into the lists of
+        existing rows it is closer to than their current last neighbour.
+
+        """
+        self.ensure_capacity()
+        row = self.vectors.rows[name]
+        self.ids[row] = MISSING
+        self.distances[row] = numpy.inf
+        self.insert(row)
+
+    def insert(self, row):
+        """Insert row into the lists of the rows it is close to."""
+        size = self.vectors.used
+        distances = self.vectors.distances(self.vectors.vector(
+            self.vectors.names[row]))
+        distances[row] = numpy.inf
+        ids = self.ids[:size]
+        known = ids[:, 0] != MISSING
+        closer = numpy.flatnonzero(
+            known & (distances < self.distances[:size, -1]) &
+            ~(ids == row).any(axis=1))
+        for other in closer:
+            position = numpy.searchsorted(
+                self.distances[other], distances[other])
+            self.ids[other, position + 1:] = self.ids[other, position:-1]
+            self.distances[other, position + 1:] = (
+                self.distances[other, position:-1])
+            self.ids[other, position] = row
+            self.distances[other, position] = distances[other]
+
+    def remove(self, name):
+        """Patch the graph for a name about to be removed from the store.
+
+        Its row becomes a hole, and rows that had it as a neighbour are
+        marked missing.
+
+        """
+        self.remove_many([name])
+
+    def remove_many(self, names):
+        """Patch the graph for several names about to be removed at once.
+
+        """
+        if self.ids is None:
+            return
+        removed = [
+            self.vectors.rows[name] for name in names
+            if name in self.vectors.rows]
+        if not removed:
+            return
+        size = self.vectors.used
+        affected = numpy.isin(self.ids[:size], removed).any(axis=1)
+        self.ids[numpy.flatnonzero(affected), 0] = MISSING
+        self.ids[removed] = MISSING
+        self.distances[removed] = numpy.inf
+
+    def compact(self, kept):
+        """Follow the store closing up its holes.
+
+        `kept` are the old rows of the rows that are left, in order.
+
+        """
+        if self.ids is None:
+            return
+        size = int(kept[-1]) + 1 if len(kept) else 0
+        translate = numpy.full(
+            max(size, self.capacity) + 1, MISSING, dtype=numpy.int32)
+        translate[kept] = numpy.arange(len(kept))
+        old = numpy.array(self.ids[kept])
+        ids = translate[old]
+        ids[((ids == MISSING) & (old != MISSING)).any(axis=1), 0] = MISSING
+        distances = numpy.array(self.distances[kept])
+        self.ids[:len(kept)] = ids
+        self.distances[:len(kept)] = distances
+        self.ids[len(kept):] = MISSING
+        self.distances[len(kept):] = numpy.inf
+
+    def compute(self, block, rows, workers=None):
+        """Compute neighbour lists for rows of block, in parallel blocks."""
+        squared = numpy.einsum('ij,ij->i', block, block)
+        chunks = [
+            rows[start:start + BLOCK_SIZE]
+            for start in range(0, len(rows), BLOCK_SIZE)]
+
+        def compute_chunk(chunk):
+            return nearest_rows(block, chunk, self.neighbours, squared)
+
+        pool = ThreadPool(workers or cpu_count())
+        try:
+            results = pool.map(compute_chunk, chunks)
+        finally:
+            pool.close()
+        if not results:
+            return (
+                numpy.zeros((0, self.neighbours), dtype=int),
+                numpy.zeros((0, self.neighbours), dtype=numpy.float32))
+        return (
+            numpy.concatenate([ids for ids, _ in results]),
+            numpy.concatenate([distances for _, distances in results]))
+
+    def repair(self, workers=None):
+        """Compute missing rows against the current contents of the store.
+
+        """
+        names, block, rows = self.snapshot()
+        if not len(rows):
+            return
+        ids, distances = self.compute(block, rows, workers)
+        self.install(names, rows, ids, distances)
+
+    def install(self, names, rows, ids, distances):
+        """Store lists computed from an earlier snapshot of the store.
+
+        `names` are the row names of the snapshot; rows and neighbours that
+        have been removed since are dropped, and rows added since are
+        inserted into the new lists.
+
+        """
+        current = self.vectors.rows
+        translate = numpy.array(
+            [current.get(name, MISSING) for name in names] + [MISSING])
+        ids = translate[ids]
+        targets = translate[rows]
+        keep = targets != MISSING
+        self.store(targets[keep], ids[keep], distances[keep])
+        dropped = (ids[keep] == MISSING).any(axis=1)
+        self.ids[targets[keep][dropped], 0] = MISSING
+        snapshot = set(names)
+        for name in self.vectors:
+            if name not in snapshot:
+                self.insert(current[name])
+
+    def store(self, rows, ids, distances):
+        """Write computed lists, padding short ones with missing entries."""
+        self.ensure_capacity()
+        found = ids.shape[1]
+        self.ids[rows, :found] = ids
+        self.distances[rows, :found] = distances
+        if found < self.neighbours:
+            self.ids[rows, found:] = MISSING
+            self.distances[rows, found:] = numpy.inf
+
+
+class GraphView(object):
+
+    """Copy of the neighbour lists of a graph, for one VectorView."""
+
+    def __init__(self, vectors, ids, distances, neighbours):
+        self.vectors = vectors
+        self.ids = ids
+        self.distances = distances
+        self.neighbours = neighbours
+
+    def lookup(self, name, number):
+        """Get (distance, name) for the neighbours of a name, if known."""
+        row = self.vectors.rows.get(name)
+        if row is None or number > self.neighbours or self.ids is None:
+            return None
+        ids = self.ids[row, :number]
+        if (ids == MISSING).any():
+            return None
+        distances = self.distances[row, :number]
+        names = [self.vectors.names[neighbour] for neighbour in ids]
+        if None in names:
+            return None
+        return [
+            (float(distance), name)
+            for name, distance in zip(names, distances)]
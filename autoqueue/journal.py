@@ -0,0 +1,84 @@
+"""Append-only journal of changes to the acoustic dataset."""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+from builtins import object
+
+
+class Journal(object):
+
+    """Log of added and removed points, kept next to a dataset snapshot.
+
+    New entries go to the active segment at `path`. Rotating renames the
+    active segment to `path.<n>`, so that a snapshot can be written in the
+    background while new entries keep coming in. Once the snapshot is on
+    disk the rotated segments it covers are discarded.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, entries):
+        """Write a batch of (operation, name, data) entries to disk."""
+        if not entries:
+            return
+        with open(self.path, 'a') as journal:
+            for operation, name, data in entries:
+                journal.write(json.dumps([operation, name, data]) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def size(self):
+        """Get the size in bytes of all segments."""
+        return sum(os.path.getsize(path) for path in self.segments())
+
+    def segments(self):
+        """Get all segments, oldest first."""
+        directory, basename = os.path.split(self.path)
+        rotated = []
+        for filename in os.listdir(directory or '.'):
+            prefix, _, number = filename.rpartition('.')
+            if prefix == basename and number.isdigit():
+                rotated.append(
+                    (int(number), os.path.join(directory, filename)))
+        segments = [path for _, path in sorted(rotated)]
+        if os.path.exists(self.path):
+            segments.append(self.path)
+        return segments
+
+    def rotate(self):
+        """Close the active segment and return all segments written so far.
+
+        """
+        segments = self.segments()
+        if self.path not in segments:
+            return segments
+        number = 0
+        if len(segments) > 1:
+            number = int(segments[-2].rpartition('.')[-1]) + 1
+        rotated = '%s.%d' % (self.path, number)
+        os.rename(self.path, rotated)
+        return segments[:-1] + [rotated]
+
+    def replay(self):
+        """Yield all entries in the order they were written."""
+        for segment in self.segments():
+            with open(segment, 'r') as journal:
+                for line in journal:
+                    try:
+                        operation, name, data = json.loads(line)
+                    except ValueError:
+                        # A partially written last line after a crash.
+                        print("skipping corrupt journal entry in %s" % segment)
+                        continue
+                    yield operation, name, data
+
+    def discard(self, segments=None):
+        """Remove segments, or all of them if none are given."""
+        for segment in self.segments() if segments is None else segments:
+            try:
+                os.remove(segment)
+            except OSError as exc:
+                print(exc)
@@ -0,0 +1,194 @@
+"""Normalization and PCA of raw descriptors with numpy."""
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+from builtins import object
+
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+from autoqueue.vectors import DIMENSION
+
+
+def size_of(shape):
+    """Number of values in a descriptor of the given shape."""
+    size = 1
+    for dimension in shape:
+        size *= dimension
+    return size
+
+
+class Projection(object):
+
+    """Maps raw descriptor vectors to the reduced vectors used for queries.
+
+    Mirrors the gaia transform: columns that are constant or not finite
+    are dropped, the rest is scaled to the range seen when fitting, and
+    projected on the first principal components. Vectors with a different
+    layout are aligned by descriptor name, missing values count as the
+    mean.
+
+    The share of variance the components leave unexplained is recorded
+    for the fitting sample, and tracked for vectors added later: when it
+    grows, the basis no longer describes the library well.
+
+    """
+
+    def __init__(self, layout, columns, minimum, scale, mean, components,
+                 baseline):
+        self.layout = [(name, list(shape)) for name, shape in layout]
+        self.columns = columns
+        self.minimum = minimum
+        self.scale = scale
+        self.mean = mean
+        self.components = components
+        self.baseline = baseline
+        self.tracked = 0
+        self.unexplained = 0.0
+        self._alignments = {}
+
+    @classmethod
+    def fit(cls, layout, matrix, dimension=DIMENSION):
+        """Fit a projection on raw vectors that all have `layout`."""
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        finite = numpy.isfinite(matrix).all(axis=0)
+        minimum = matrix.min(axis=0)
+        maximum = matrix.max(axis=0)
+        columns = numpy.flatnonzero(finite & (maximum > minimum))
+        minimum = minimum[columns]
+        scale = maximum[columns] - minimum
+        normalized = (matrix[:, columns] - minimum) / scale
+        mean = normalized.mean(axis=0)
+        _, _, basis = numpy.linalg.svd(
+            normalized - mean, full_matrices=False)
+        components = numpy.zeros((dimension, len(columns)))
+        components[:min(dimension, len(basis))] = basis[:dimension]
+        projection = cls(
+            layout, columns, minimum, scale, mean, components, 0.0)
+        projection.baseline = float(
+            projection.unexplained_share(normalized - mean).mean())
+        return projection
+
+    @classmethod
+    def load(cls, path):
+        """Load a projection saved with save."""
+        with open(path, 'rb') as saved:
+            data = numpy.load(saved)
+            projection = cls(
+                json.loads(str(data['layout'])), data['columns'],
+                data['minimum'], data['scale'], data['mean'],
+                data['components'], float(data['baseline']))
+        try:
+            with open(path + '.json', 'r') as statistics:
+                data = json.load(statistics)
+        except (IOError, OSError, ValueError):
+            data = {}
+        projection.tracked = data.get('tracked', 0)
+        projection.unexplained = data.get('unexplained', 0.0)
+        return projection
+
+    def save(self, path):
+        """Write the projection to disk."""
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as saved:
+            numpy.savez(
+                saved, layout=numpy.array(json.dumps(self.layout)),
+                columns=self.columns, minimum=self.minimum, scale=self.scale,
+                mean=self.mean, components=self.components,
+                baseline=numpy.array(self.baseline))
+        os.rename(temporary, path)
+        self.save_statistics(path)
+
+    def save_statistics(self, path):
+        """Write the drift statistics next to a saved projection."""
+        temporary = path + '.json.tmp'
+        with open(temporary, 'w') as statistics:
+            json.dump(
+                {'tracked': self.tracked, 'unexplained': self.unexplained},
+                statistics)
+        os.rename(temporary, path + '.json')
+
+    @property
+    def drift(self):
+        """Relative growth of the unexplained variance since fitting."""
+        if not self.tracked or not self.baseline:
+            return 0.0
+        return self.unexplained / self.tracked / self.baseline - 1
+
+    def alignment(self, layout):
+        """Get indices into vectors of `layout` for every model position.
+
+        Positions of descriptors the layout does not have are -1.
+
+        """
+        key = json.dumps(layout)
+        if key not in self._alignments:
+            offsets = {}
+            offset = 0
+            for name, shape in layout:
+                offsets[name] = (offset, list(shape))
+                offset += size_of(shape)
+            indices = []
+            for name, shape in self.layout:
+                size = size_of(shape)
+                start, known_shape = offsets.get(name, (None, None))
+                if known_shape == shape:
+                    indices.extend(range(start, start + size))
+                else:
+                    indices.extend([-1] * size)
+            self._alignments[key] = numpy.array(indices)
+        return self._alignments[key]
+
+    def align(self, layout, matrix):
+        """Rearrange raw vectors with `layout` into the model layout."""
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        indices = self.alignment(layout)
+        present = indices >= 0
+        if present.all() and matrix.shape[1] == len(indices):
+            return matrix[:, indices]
+        aligned = numpy.full((len(matrix), len(indices)), numpy.nan)
+        aligned[:, present] = matrix[:, indices[present]]
+        return aligned
+
+    def normalize(self, matrix):
+        """Scale and center raw vectors in the model layout."""
+        normalized = (
+            numpy.asarray(matrix, dtype=numpy.float64)[:, self.columns] -
+            self.minimum) / self.scale - self.mean
+        normalized[~numpy.isfinite(normalized)] = 0
+        return normalized
+
+    def unexplained_share(self, normalized):
+        """Share of the variance of each vector outside the components."""
+        total = numpy.einsum('ij,ij->i', normalized, normalized)
+        explained = normalized.dot(self.components.T)
+        explained = numpy.einsum('ij,ij->i', explained, explained)
+        return 1 - explained / numpy.maximum(total, numpy.finfo(float).tiny)
+
+    def project(self, matrix):
+        """Project raw vectors in the model layout."""
+        return self.normalize(matrix).dot(self.components.T).astype(
+            numpy.float32)
+
+    def project_vector(self, layout, values):
+        """Project the raw vector of one track."""
+        return self.project(self.align(layout, [values]))[0]
+
+    def project_descriptors(self, descriptors):
+        """Project the (name, shape, values) descriptors of one track."""
+        return self.project_vector(
+            [(name, list(shape)) for name, shape, _ in descriptors],
+            [value for _, _, numbers in descriptors for value in numbers])
+
+    def track(self, descriptors):
+        """Project the descriptors of a new track and record its fit."""
+        normalized = self.normalize(self.align(
+            [(name, list(shape)) for name, shape, _ in descriptors],
+            [[value for _, _, numbers in descriptors for value in numbers]]))
+        self.tracked += 1
+        self.unexplained += float(self.unexplained_share(normalized)[0])
+        return normalized.dot(self.components.T)[0].astype(numpy.float32)
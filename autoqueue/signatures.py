@@ -0,0 +1,108 @@
+"""Load essentia extractor signatures."""
+from __future__ import absolute_import, division, print_function
+
+import json
+
+# Descriptors the gaia transform removes before computing distances.
+EXCLUDED_DESCRIPTORS = (
+    'beats_position', 'bpm_estimates', 'bpm_intervals', 'onset_times',
+    'oddtoevenharmonicenergyratio')
+
+
+def load_signature(signame, exclude=()):
+    """Load signature data from an extractor JSON file.
+
+    Metadata tags are always left out, and so is every descriptor named in
+    `exclude`, which is dropped as soon as its object has been parsed.
+
+    """
+    excluded = frozenset(exclude)
+
+    def drop_excluded(pairs):
+        return dict(
+            (key, value) for key, value in pairs if key not in excluded)
+
+    with open(signame, 'r') as sig:
+        jsonsig = json.load(
+            sig, object_pairs_hook=drop_excluded if excluded else None)
+    if jsonsig.get('metadata', {}).get('tags'):
+        del jsonsig['metadata']['tags']
+    return jsonsig
+
+
+def flatten_signature(jsonsig, exclude=()):
+    """Get (name, shape, values) for every numeric descriptor, by name.
+
+    Nested names are joined with dots and lists and matrices are flattened,
+    with their shape kept so they can be rebuilt. String descriptors like
+    the key and scale, metadata, and descriptors in `exclude` are skipped.
+
+    """
+    descriptors = []
+    _flatten(
+        dict((key, value) for key, value in jsonsig.items()
+             if key != 'metadata'),
+        '', frozenset(exclude), descriptors)
+    return descriptors
+
+
+def _flatten(value, name, excluded, descriptors):
+    if isinstance(value, dict):
+        for key in sorted(value):
+            if key in excluded:
+                continue
+            _flatten(
+                value[key], name + '.' + key if name else key, excluded,
+                descriptors)
+        return
+    shape = _shape(value)
+    if shape is not None:
+        descriptors.append((name, shape, _numbers(value)))
+
+
+def _shape(value):
+    if isinstance(value, (bool, int, float)):
+        return []
+    if not isinstance(value, list) or not value:
+        return None
+    shapes = [_shape(item) for item in value]
+    if shapes[0] is None or any(shape != shapes[0] for shape in shapes):
+        return None
+    return [len(value)] + shapes[0]
+
+
+def _numbers(value):
+    if isinstance(value, list):
+        return [number for item in value for number in _numbers(item)]
+    return [float(value)]
+
+
+def average_signatures(jsonsigs):
+    """Average the numbers in signatures of excerpts of one track.
+
+    Values that are not numbers, and lists whose lengths differ, such as
+    the times of beats, are taken from the first signature.
+
+    """
+    first = jsonsigs[0]
+    if isinstance(first, dict):
+        return dict(
+            (key, average_signatures([
+                jsonsig[key] for jsonsig in jsonsigs
+                if isinstance(jsonsig, dict) and key in jsonsig]))
+            for key in first)
+    if isinstance(first, list):
+        if all(isinstance(jsonsig, list) and len(jsonsig) == len(first)
+               for jsonsig in jsonsigs):
+            return [average_signatures(list(values))
+                    for values in zip(*jsonsigs)]
+        return first
+    if all(isinstance(jsonsig, (int, float)) and
+           not isinstance(jsonsig, bool) for jsonsig in jsonsigs):
+        return sum(jsonsigs) / len(jsonsigs)
+    return first
+
+
+def load_descriptors(signame):
+    """Load only the descriptors the transform keeps, flattened."""
+    return flatten_signature(load_signature(signame, EXCLUDED_DESCRIPTORS))
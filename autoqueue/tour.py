@@ -0,0 +1,129 @@
+"""Order tracks along a short path through their distance matrix."""
+from __future__ import absolute_import, division, print_function
+
+from builtins import range
+from time import time
+
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+# Miximize engines: clusters chained from the closest pairs, or one path
+# improved by local search.
+CLUSTERS = 'clusters'
+TOUR = 'tour'
+ENGINES = (CLUSTERS, TOUR)
+# Seconds miximize may spend ordering tracks with the tour engine, finding
+# the clusters it starts from included.
+TOUR_BUDGET = 1.0
+# Longest run of tracks an Or-opt move takes along.
+SEGMENT_LENGTH = 3
+# Changes in length smaller than this are rounding errors.
+EPSILON = 1e-9
+
+
+def path_length(distances, order):
+    """Sum of the distances between consecutive tracks."""
+    return sum(
+        distances[track][following]
+        for track, following in zip(order, order[1:]))
+
+
+def shortest_path(distances, budget=TOUR_BUDGET, order=None):
+    """Find a short path through all rows of a dense distance matrix.
+
+    The path starts out as `order`, or by nearest neighbours without one,
+    and is improved with 2-opt and Or-opt moves until neither finds
+    anything or `budget` seconds have passed. An extra stop at distance
+    zero from every track closes the path into a tour, so that both ends
+    are free to move.
+
+    """
+    deadline = time() + budget
+    size = len(distances)
+    if size < 3:
+        return list(range(size))
+    matrix = numpy.zeros((size + 1, size + 1))
+    matrix[:size, :size] = distances
+    if order is None:
+        tour = nearest_neighbours(matrix)
+    else:
+        tour = numpy.array(list(order) + [size], dtype=numpy.intp)
+    improved = True
+    while improved and time() < deadline:
+        tour, improved = two_opt(matrix, tour, deadline)
+        tour, moved = or_opt(matrix, tour, deadline)
+        improved = improved or moved
+    start = int(numpy.flatnonzero(tour == size)[0])
+    return numpy.concatenate((tour[start + 1:], tour[:start])).tolist()
+
+
+def nearest_neighbours(matrix):
+    """Visit the closest unvisited stop next, starting from the last."""
+    size = len(matrix)
+    tour = numpy.empty(size, dtype=numpy.intp)
+    visited = numpy.zeros(size, dtype=bool)
+    current = size - 1
+    for position in range(size):
+        tour[position] = current
+        visited[current] = True
+        if position + 1 < size:
+            current = int(numpy.argmin(
+                numpy.where(visited, numpy.inf, matrix[current])))
+    return tour
+
+
+def two_opt(matrix, tour, deadline):
+    """Reverse stretches of the tour wherever that makes it shorter."""
+    size = len(tour)
+    improved = False
+    for first in range(size - 2):
+        if time() >= deadline:
+            break
+        before, after = tour[first], tour[first + 1]
+        # Ends of the edges the edge (before, after) could be swapped with.
+        starts = tour[first + 2:]
+        ends = numpy.append(tour[first + 3:], tour[0])
+        change = (
+            matrix[before, starts] + matrix[after, ends] -
+            matrix[before, after] - matrix[starts, ends])
+        best = int(numpy.argmin(change))
+        if change[best] < -EPSILON:
+            last = first + 2 + best
+            tour[first + 1:last + 1] = tour[first + 1:last + 1][::-1].copy()
+            improved = True
+    return tour, improved
+
+
+def or_opt(matrix, tour, deadline):
+    """Move short runs of tracks, maybe reversed, to where they fit best."""
+    size = len(tour)
+    improved = False
+    for position in range(size):
+        for length in range(1, min(SEGMENT_LENGTH, size - 3) + 1):
+            if time() >= deadline:
+                return tour, improved
+            rotated = numpy.roll(tour, -position)
+            segment, rest = rotated[:length], rotated[length:]
+            head, tail = segment[0], segment[-1]
+            saved = (
+                matrix[rest[-1], head] + matrix[tail, rest[0]] -
+                matrix[rest[-1], rest[0]])
+            starts, ends = rest[:-1], rest[1:]
+            kept = matrix[starts, ends]
+            forward = matrix[starts, head] + matrix[tail, ends] - kept
+            backward = matrix[starts, tail] + matrix[head, ends] - kept
+            best_forward = int(numpy.argmin(forward))
+            best_backward = int(numpy.argmin(backward))
+            if forward[best_forward] <= backward[best_backward]:
+                best, cost = best_forward, forward[best_forward]
+            else:
+                best, cost = best_backward, backward[best_backward]
+                segment = segment[::-1]
+            if cost - saved < -EPSILON:
+                tour = numpy.concatenate(
+                    (rest[:best + 1], segment, rest[best + 1:]))
+                improved = True
+    return tour, improved
@@ -0,0 +1,434 @@
+"""Memory-mapped store of transformed acoustic descriptor vectors."""
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+from builtins import object, range
+
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
+
+DIMENSION = 30
+MINIMUM_CAPACITY = 1024
+# Fraction of the rows that may be holes before the matrix is compacted.
+HOLE_FRACTION = .25
+# Seeds per matrix product in nearest_many, to bound memory use.
+BATCH_SIZE = 256
+
+
+def smallest(distances, number):
+    """Get the indices of the smallest distances, in ascending order.
+
+    Only the selected part is sorted, the rest is partitioned off.
+
+    """
+    number = min(number, len(distances))
+    if number <= 0:
+        return numpy.zeros(0, dtype=int)
+    if number < len(distances):
+        indices = numpy.argpartition(distances, number - 1)[:number]
+    else:
+        indices = numpy.arange(len(distances))
+    return indices[numpy.argsort(distances[indices], kind='stable')]
+
+
+def pairwise_distances(block):
+    """Get the dense matrix of euclidean distances between rows."""
+    block = numpy.asarray(block, dtype=numpy.float64)
+    squared = numpy.einsum('ij,ij->i', block, block)
+    distances = squared[:, None] + squared[None, :] - 2 * block.dot(block.T)
+    numpy.maximum(distances, 0, out=distances)
+    numpy.fill_diagonal(distances, 0)
+    return numpy.sqrt(distances)
+
+
+def nearest_rows(block, rows, number, squared=None, excluded=None):
+    """Get the nearest other rows of block for some of its rows.
+
+    Returns two arrays with one line per row in `rows`: the indices of the
+    neighbours, and their distances, both in ascending order of distance.
+    Rows in `excluded` are never returned as neighbours.
+
+    """
+    if excluded is not None and len(excluded):
+        number = min(number, len(block) - len(excluded) - 1)
+    else:
+        excluded = None
+        number = min(number, len(block) - 1)
+    if number <= 0:
+        return (
+            numpy.zeros((len(rows), 0), dtype=int),
+            numpy.zeros((len(rows), 0), dtype=numpy.float32))
+    if squared is None:
+        squared = numpy.einsum('ij,ij->i', block, block)
+    rows = numpy.asarray(rows)
+    distances = (
+        squared[rows][:, numpy.newaxis] + squared[numpy.newaxis, :] -
+        2 * block[rows].dot(block.T))
+    numpy.sqrt(numpy.maximum(distances, 0, out=distances), out=distances)
+    distances[numpy.arange(len(rows)), rows] = numpy.inf
+    if excluded is not None:
+        distances[:, excluded] = numpy.inf
+    nearest = numpy.argpartition(distances, number - 1, axis=1)[:, :number]
+    nearest_distances = numpy.take_along_axis(distances, nearest, axis=1)
+    order = numpy.argsort(nearest_distances, axis=1, kind='stable')
+    return (
+        numpy.take_along_axis(nearest, order, axis=1),
+        numpy.take_along_axis(nearest_distances, order, axis=1))
+
+
+class VectorStore(object):
+
+    """Float32 matrix with one row of descriptors per track.
+
+    The matrix lives in a memory-mapped file, so opening the store does
+    not read the data and processes that map the same file share its
+    pages. Rows are only ever appended: removing a track leaves a hole,
+    until holes take up more than HOLE_FRACTION of the rows and the live
+    ones are compacted into a new file.
+
+    The index is a log of changes next to the matrix: a header naming the
+    generation of the matrix file, then one [row, name] line per added
+    row, with a null name for a removed one. Flushing appends the lines
+    for the changes since the last flush. Compacting and replacing write
+    the matrix to a file of the next generation and then switch to it by
+    replacing the index, so the names in the index always match the rows
+    on disk.
+
+    """
+
+    def __init__(self, path, dimension=DIMENSION, readonly=False):
+        self.path = path
+        self.index_path = path + '.index'
+        self.dimension = dimension
+        self.readonly = readonly
+        self.generation = 0
+        self.names = []
+        self.rows = {}
+        self.holes = set()
+        self.matrix = None
+        # Index lines for the changes since the last flush.
+        self.unwritten = []
+        self.load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __iter__(self):
+        return (name for name in self.names if name is not None)
+
+    @property
+    def capacity(self):
+        """Number of rows the file on disk has room for."""
+        if self.matrix is None:
+            return 0
+        return self.matrix.shape[0]
+
+    @property
+    def used(self):
+        """Number of rows in use, holes included."""
+        return len(self.names)
+
+    @property
+    def matrix_path(self):
+        """Path of the matrix file of the current generation."""
+        return '%s.%d' % (self.path, self.generation)
+
+    @property
+    def block(self):
+        """View of the rows that are in use, holes included."""
+        if self.matrix is None:
+            return numpy.zeros((0, self.dimension), dtype=numpy.float32)
+        return self.matrix[:len(self.names)]
+
+    def load(self):
+        """Map the matrix file and replay the index."""
+        self.generation = 0
+        self.names, self.rows, self.holes = [], {}, set()
+        self.matrix = None
+        self.unwritten = []
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as index:
+            lines = index.readlines()
+        try:
+            header = json.loads(lines[0].decode('utf-8'))
+        except (IndexError, ValueError) as exc:
+            print(exc)
+            self._discard()
+            return
+        if header.get('dimension') != self.dimension or (
+                'generation' not in header):
+            print("vector store has a different format, ignoring it")
+            self._discard()
+            return
+        self.generation = header['generation']
+        size = len(lines[0])
+        for line in lines[1:]:
+            try:
+                row, name = json.loads(line.decode('utf-8'))
+                if not line.endswith(b'\n') or not self._replay(row, name):
+                    raise ValueError(line)
+            except (TypeError, ValueError):
+                # A partially written last line after a crash. Cut it off,
+                # so that the next flush does not append to it.
+                print("truncating vector store index after %d rows" % len(
+                    self.names))
+                if not self.readonly:
+                    with open(self.index_path, 'ab') as index:
+                        index.truncate(size)
+                break
+            size += len(line)
+        self.matrix = self._map()
+        if self.capacity < len(self.names):
+            print("vector store index does not match matrix, ignoring it")
+            self._discard()
+            return
+        if not self.readonly:
+            self._remove_other_generations()
+
+    def _discard(self):
+        """Start over empty, without the index that could not be used."""
+        self.generation = 0
+        self.names, self.rows, self.holes = [], {}, set()
+        self.matrix = None
+        if not self.readonly:
+            os.remove(self.index_path)
+
+    def _replay(self, row, name):
+        """Apply an index line, return whether it fits the ones before."""
+        if name is None:
+            if row >= len(self.names) or self.names[row] is None:
+                return False
+            del self.rows[self.names[row]]
+            self.names[row] = None
+            self.holes.add(row)
+            return True
+        if row != len(self.names) or name in self.rows:
+            return False
+        self.names.append(name)
+        self.rows[name] = row
+        return True
+
+    def _remove_other_generations(self):
+        """Remove matrix files left behind by an interrupted switch."""
+        directory, basename = os.path.split(self.path)
+        for filename in os.listdir(directory or '.'):
+            prefix, _, number = filename.rpartition('.')
+            if (prefix == basename and number.isdigit() and
+                    int(number) != self.generation):
+                os.remove(os.path.join(directory, filename))
+
+    def _map(self):
+        path = self.matrix_path
+        rows = 0
+        if os.path.exists(path):
+            rows = os.path.getsize(path) // (4 * self.dimension)
+        if not rows:
+            return None
+        return numpy.memmap(
+            path, dtype=numpy.float32, mode='r' if self.readonly else 'r+',
+            shape=(rows, self.dimension))
+
+    def _grow(self):
+        capacity = max(MINIMUM_CAPACITY, 2 * self.capacity)
+        if self.matrix is not None:
+            self.matrix.flush()
+        with open(self.matrix_path, 'ab') as matrix:
+            matrix.truncate(capacity * 4 * self.dimension)
+        self.matrix = self._map()
+
+    def snapshot(self):
+        """Get a copy of the names and vectors of the live rows."""
+        live = [row for row, name in enumerate(self.names) if name is not None]
+        return [self.names[row] for row in live], self.block[live]
+
+    def view(self):
+        """Get a view of the current contents for queries to use."""
+        return VectorView(
+            list(self.names), dict(self.rows),
+            numpy.array(sorted(self.holes), dtype=int), self.block)
+
+    def vector(self, name):
+        """Get the vector for a name."""
+        return self.matrix[self.rows[name]]
+
+    def vectors(self, names):
+        """Get a block with the vectors for a list of names."""
+        return self.block[[self.rows[name] for name in names]]
+
+    def add(self, name, vector):
+        """Add the vector for a name, in a new row if it had one already."""
+        self.remove(name)
+        if len(self.names) == self.capacity:
+            self._grow()
+        row = len(self.names)
+        self.names.append(name)
+        self.rows[name] = row
+        self.matrix[row] = vector
+        self.unwritten.append((row, name))
+
+    def remove(self, name):
+        """Remove a name, leaving a hole where its row was."""
+        row = self.rows.pop(name, None)
+        if row is None:
+            return
+        self.names[row] = None
+        self.holes.add(row)
+        self.unwritten.append((row, None))
+
+    def remove_many(self, names):
+        """Remove several names at once."""
+        for name in names:
+            self.remove(name)
+
+    def compaction_needed(self):
+        """Check whether holes take up too many rows."""
+        return len(self.holes) > HOLE_FRACTION * len(self.names)
+
+    def compact(self):
+        """Close up the holes, keeping the live rows in order.
+
+        Returns the old rows of the names that are left.
+
+        """
+        kept = numpy.array([
+            row for row, name in enumerate(self.names) if name is not None],
+            dtype=int)
+        self._rewrite(
+            [self.names[row] for row in kept], self.block[kept])
+        return kept
+
+    def replace(self, names, matrix):
+        """Replace the contents of the store with a new matrix."""
+        self._rewrite(names, numpy.asarray(matrix, dtype=numpy.float32))
+
+    def _rewrite(self, names, block):
+        """Switch to a matrix file of the next generation holding block."""
+        generation = self.generation + 1
+        path = '%s.%d' % (self.path, generation)
+        with open(path, 'wb') as matrix:
+            matrix.write(numpy.ascontiguousarray(
+                block, dtype=numpy.float32).reshape(
+                    (len(names), self.dimension)).tobytes())
+            matrix.flush()
+            os.fsync(matrix.fileno())
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'w') as index:
+            index.write(json.dumps(
+                {'dimension': self.dimension, 'generation': generation}) +
+                '\n')
+            for row, name in enumerate(names):
+                index.write(json.dumps([row, name]) + '\n')
+            index.flush()
+            os.fsync(index.fileno())
+        os.rename(temporary, self.index_path)
+        old = self.matrix_path
+        self.generation = generation
+        self.names = list(names)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.holes = set()
+        self.unwritten = []
+        self.matrix = self._map()
+        if os.path.exists(old):
+            os.remove(old)
+
+    def flush(self):
+        """Write changes to disk.
+
+        The rows go first, so that the index never names a row that is not
+        on disk yet.
+
+        """
+        if self.matrix is not None:
+            self.matrix.flush()
+        header = not os.path.exists(self.index_path)
+        if not (header or self.unwritten):
+            return
+        with open(self.index_path, 'a') as index:
+            if header:
+                index.write(json.dumps({
+                    'dimension': self.dimension,
+                    'generation': self.generation}) + '\n')
+            for row, name in self.unwritten:
+                index.write(json.dumps([row, name]) + '\n')
+            index.flush()
+            os.fsync(index.fileno())
+        self.unwritten = []
+
+    def distances(self, vector, block=None):
+        """Get euclidean distances from vector to every row of a block."""
+        if block is None:
+            block = self.block
+        difference = block - vector
+        return numpy.sqrt(numpy.einsum('ij,ij->i', difference, difference))
+
+
+class VectorView(object):
+
+    """The contents of a VectorStore at one point, never changed again.
+
+    Holds copies of the names and the row map, and a view of the rows in
+    use at the time. The store only appends rows and writes compacted ones
+    to a new file, so the rows a view covers stay as they were, and queries
+    can use it while the store goes on changing.
+
+    """
+
+    def __init__(self, names, rows, holes, block):
+        self.names = names
+        self.rows = rows
+        self.holes = holes
+        self.block = block
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def vector(self, name):
+        """Get the vector for a name."""
+        return self.block[self.rows[name]]
+
+    def vectors(self, names):
+        """Get a block with the vectors for a list of names."""
+        return self.block[[self.rows[name] for name in names]]
+
+    def distances(self, vector, block=None):
+        """Get euclidean distances from vector to every row of a block."""
+        if block is None:
+            block = self.block
+        difference = block - vector
+        return numpy.sqrt(numpy.einsum('ij,ij->i', difference, difference))
+
+    def nearest(self, name, number):
+        """Get (distance, name) for the nearest neighbours of a name."""
+        distances = self.distances(self.vector(name))
+        distances[self.rows[name]] = numpy.inf
+        distances[self.holes] = numpy.inf
+        return [
+            (float(distances[row]), self.names[row])
+            for row in smallest(distances, min(number, len(self) - 1))]
+
+    def nearest_many(self, names, number):
+        """Get (distance, name) neighbour lists for several names at once."""
+        block = self.block
+        squared = numpy.einsum('ij,ij->i', block, block)
+        result = []
+        for start in range(0, len(names), BATCH_SIZE):
+            rows = [
+                self.rows[name] for name in names[start:start + BATCH_SIZE]]
+            neighbours, distances = nearest_rows(
+                block, rows, number, squared, self.holes)
+            for seed_neighbours, seed_distances in zip(neighbours, distances):
+                result.append([
+                    (float(distance), self.names[row])
+                    for row, distance in zip(seed_neighbours, seed_distances)])
+        return result
@@ -0,0 +1,130 @@
+"""Work queue for the acoustic analysis thread."""
+from __future__ import absolute_import, print_function
+
+from builtins import object
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition
+from time import time
+from queue import Empty
+
+ADD = 'add'
+REMOVE = 'remove'
+MERGE = 'merge'
+
+# Priorities: files something is waiting on, like the song that is playing
+# or the seed of a query, everything else, and bulk library analysis.
+URGENT = 0
+NORMAL = 1
+BULK = 2
+# Seconds a job has to wait to move up one priority.
+AGING_INTERVAL = 5 * 60
+
+
+class WorkQueue(object):
+
+    """Queue of (command, filename) jobs, at most one pending per file.
+
+    Jobs are handed out by priority, and in order of arrival within one.
+    Every AGING_INTERVAL a job waits counts as one step up in priority,
+    so that bulk work still makes progress while urgent jobs keep coming
+    in. Queuing a file again can raise the priority of its pending job,
+    never lower it.
+
+    Queuing an ADD for a file that already has one pending does not add
+    another, and a REMOVE replaces a pending ADD, since there is no point
+    in analyzing a file about to be removed. A file removed and then added
+    again keeps both, in that order.
+
+    MERGE jobs, which hand finished extractions back to the analysis
+    thread, are never coalesced and go before everything else.
+
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.merges = deque()
+        self.pending = {}
+        self.heap = []
+        self.counter = count()
+
+    def put(self, job, block=True, timeout=None, priority=NORMAL):
+        """Queue up a (command, filename) job."""
+        command, filename = job
+        with self.condition:
+            if command == MERGE:
+                self.merges.append(job)
+            else:
+                self._put(command, filename, priority)
+            self.condition.notify()
+
+    def _put(self, command, filename, priority):
+        deadline = time() + priority * AGING_INTERVAL
+        if filename in self.pending:
+            known, _, commands = self.pending[filename]
+            deadline = min(known, deadline)
+        else:
+            commands = []
+        if commands and commands[-1] == ADD:
+            commands.pop()
+        if command == ADD or not commands:
+            commands.append(command)
+        sequence = next(self.counter)
+        self.pending[filename] = (deadline, sequence, commands)
+        heappush(self.heap, (deadline, sequence, filename))
+
+    def get(self, block=True, timeout=None, merges_only=False):
+        """Get the next job, raise Empty if there is none.
+
+        With `merges_only`, other jobs are held back, for when there is no
+        room to start more extractions.
+
+        """
+        with self.condition:
+            if block:
+                self.condition.wait_for(
+                    lambda: self._ready(merges_only), timeout)
+            if not self._ready(merges_only):
+                raise Empty
+            if self.merges:
+                return self.merges.popleft()
+            entry = heappop(self.heap)
+            filename = entry[2]
+            commands = self.pending[filename][2]
+            command = commands.pop(0)
+            if not commands:
+                del self.pending[filename]
+            else:
+                heappush(self.heap, entry)
+            return command, filename
+
+    def _ready(self, merges_only=False):
+        if merges_only:
+            return bool(self.merges)
+        # Drop heap entries left behind by jobs that were queued again.
+        while self.heap:
+            _, sequence, filename = self.heap[0]
+            if self.pending.get(filename, (None, None))[1] == sequence:
+                break
+            heappop(self.heap)
+        return bool(self.merges or self.heap)
+
+    def qsize(self):
+        """Number of queued jobs."""
+        with self.condition:
+            return len(self.merges) + sum(
+                len(commands) for _, _, commands in self.pending.values())
+
+    def empty(self):
+        """Whether there are no queued jobs."""
+        return not self.qsize()
+
+    def backlog(self):
+        """Number of queued jobs by command."""
+        with self.condition:
+            backlog = {ADD: 0, REMOVE: 0, MERGE: len(self.merges)}
+            for _, _, commands in self.pending.values():
+                for command in commands:
+                    backlog[command] += 1
+            return backlog
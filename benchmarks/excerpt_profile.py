@@ -0,0 +1,98 @@
+"""Compare the excerpt analysis profile against full extraction.
+
+Usage: python benchmarks/excerpt_profile.py AUDIOFILE [AUDIOFILE ...]
+
+Extracts every file in full and from excerpts, and reports the time each
+took. Accuracy is measured on the descriptors the transform keeps, scaled
+to the range seen over all files: the mean absolute difference between
+the two profiles, and how many of each file's nearest neighbours among
+the other files stay the same. Files too short for excerpts are skipped.
+Needs the essentia extractor, mutagen and numpy.
+"""
+from __future__ import division, print_function
+
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy
+
+from autoqueue.excerpts import get_excerpts
+from autoqueue.signatures import load_descriptors
+from autoqueue.similarity import GaiaAnalysis
+
+NEIGHBOURS = 5
+
+
+def extract(filename, excerpts=None):
+    """Get the kept descriptors of a file as one vector, and the time."""
+    handle, signame = tempfile.mkstemp(suffix='.sig')
+    os.close(handle)
+    os.remove(signame)
+    start = default_timer()
+    if excerpts is None:
+        GaiaAnalysis.essentia_analyze(filename, signame)
+    else:
+        GaiaAnalysis.excerpt_analyze(filename, signame, excerpts)
+    elapsed = default_timer() - start
+    try:
+        return [
+            number for _, _, values in load_descriptors(signame)
+            for number in values], elapsed
+    finally:
+        os.remove(signame)
+
+
+def neighbours(block, number):
+    """Get the rows of the nearest neighbours of every row."""
+    distances = ((block[:, None, :] - block[None, :, :]) ** 2).sum(axis=2)
+    numpy.fill_diagonal(distances, numpy.inf)
+    return numpy.argsort(distances, axis=1)[:, :number]
+
+
+def main(filenames):
+    if not filenames:
+        print(__doc__)
+        return 1
+    full, fast = [], []
+    full_time = fast_time = 0
+    for filename in filenames:
+        excerpts = get_excerpts(filename)
+        if excerpts is None:
+            print("skipping %s" % filename)
+            continue
+        vector, elapsed = extract(filename)
+        full.append(vector)
+        full_time += elapsed
+        vector, elapsed = extract(filename, excerpts)
+        fast.append(vector)
+        fast_time += elapsed
+    if len(full) <= NEIGHBOURS:
+        print("need more than %d files long enough for excerpts" % (
+            NEIGHBOURS))
+        return 1
+    full = numpy.array(full)
+    fast = numpy.array(fast)
+    minimum = full.min(axis=0)
+    scale = full.max(axis=0) - minimum
+    scale[scale == 0] = 1
+    full = (full - minimum) / scale
+    fast = (fast - minimum) / scale
+    overlap = numpy.mean([
+        len(set(expected) & set(found)) / NEIGHBOURS
+        for expected, found in zip(
+            neighbours(full, NEIGHBOURS), neighbours(fast, NEIGHBOURS))])
+    print("%d files" % len(full))
+    print("full:    %8.2f s per file" % (full_time / len(full)))
+    print("excerpt: %8.2f s per file (%.1fx)" % (
+        fast_time / len(full), full_time / fast_time))
+    print("mean absolute difference of scaled descriptors: %.4f" % (
+        numpy.abs(full - fast).mean()))
+    print("%d nearest neighbours in common: %.0f%%" % (
+        NEIGHBOURS, 100 * overlap))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
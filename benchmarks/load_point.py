@@ -0,0 +1,88 @@
+"""Compare ways of loading extractor signatures.
+
+Usage: python benchmarks/load_point.py SIGFILE [SIGFILE ...]
+
+Times the old json -> yaml.dump -> Point path against loading the JSON
+straight into a Point, and against loading only the descriptors the
+transform keeps into a flat vector. The Point paths are skipped when gaia
+is not installed.
+"""
+from __future__ import division, print_function
+
+import json
+import sys
+from timeit import default_timer
+
+import yaml
+
+from autoqueue.signatures import load_descriptors, load_signature
+
+try:
+    from gaia2 import Point
+    GAIA = True
+except ImportError:
+    GAIA = False
+
+REPEAT = 5
+
+
+def yaml_round_trip(signame):
+    """The way GaiaAnalysis used to load points."""
+    with open(signame, 'r') as sig:
+        jsonsig = json.load(sig)
+        if jsonsig.get('metadata', {}).get('tags'):
+            del jsonsig['metadata']['tags']
+        yamlsig = yaml.dump(jsonsig)
+    if GAIA:
+        point = Point()
+        point.loadFromString(yamlsig)
+        return point
+    return yamlsig
+
+
+def direct(signame):
+    """Hand the JSON to the point parser as it is."""
+    jsonsig = json.dumps(load_signature(signame))
+    if GAIA:
+        point = Point()
+        point.loadFromString(jsonsig)
+        return point
+    return jsonsig
+
+
+def vector(signame):
+    """Load only the kept descriptors, flattened."""
+    return [
+        number for _, _, values in load_descriptors(signame)
+        for number in values]
+
+
+def measure(function, signames):
+    """Get the best time per signature over REPEAT runs, in ms."""
+    best = None
+    for _ in range(REPEAT):
+        start = default_timer()
+        for signame in signames:
+            function(signame)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return 1000 * best / len(signames)
+
+
+def main(signames):
+    if not signames:
+        print(__doc__)
+        return 1
+    print("%d signatures, gaia %s" % (
+        len(signames), "installed" if GAIA else "not installed"))
+    baseline = measure(yaml_round_trip, signames)
+    print("yaml round trip:   %8.2f ms" % baseline)
+    for name, function in (('direct json:', direct), ('kept vector:', vector)):
+        elapsed = measure(function, signames)
+        print("%-18s %8.2f ms (%.1fx)" % (name, elapsed, baseline / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+"""Compare the miximize engines on random vectors.
+
+Usage: python benchmarks/miximize.py [SIZE ...]
+
+Orders SIZE random vectors (500, 1000 and 2000 by default) with the
+clusters engine and with the tour engine, and prints the total distance
+between consecutive tracks and the time each took. Like miximize, the
+tour engine gets what is left of its budget after clustering. The vectors
+are drawn around a few centres, like the tracks of a library are grouped
+by genre.
+"""
+from __future__ import division, print_function
+
+import sys
+from timeit import default_timer
+
+import numpy
+
+from autoqueue.similarity import Clusterer
+from autoqueue.tour import TOUR_BUDGET, path_length, shortest_path
+from autoqueue.vectors import DIMENSION, pairwise_distances
+
+CENTRES = 20
+SPREAD = 0.3
+
+
+def random_vectors(size, seed=0):
+    """Get vectors spread around random centres."""
+    state = numpy.random.RandomState(seed)
+    centres = state.rand(CENTRES, DIMENSION)
+    return (
+        centres[state.randint(0, CENTRES, size)] +
+        state.rand(size, DIMENSION) * SPREAD).astype(numpy.float32)
+
+
+def main(sizes):
+    sizes = [int(size) for size in sizes] or [500, 1000, 2000]
+    print("%6s %12s %8s %12s %8s %7s" % (
+        "tracks", "clusters", "s", "tour", "s", "gain"))
+    for size in sizes:
+        distances = pairwise_distances(random_vectors(size))
+        start = default_timer()
+        clusterer = Clusterer(list(range(size)), distances)
+        clusterer.cluster()
+        clustered = [row for cluster in clusterer.clusters for row in cluster]
+        clustered_time = default_timer() - start
+        tour = shortest_path(
+            distances, max(0, TOUR_BUDGET - clustered_time), clustered)
+        tour_time = default_timer() - start
+        before = path_length(distances, clustered)
+        after = path_length(distances, tour)
+        print("%6d %12.2f %8.2f %12.2f %8.2f %6.1f%%" % (
+            size, before, clustered_time, after, tour_time,
+            100 * (before - after) / before))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
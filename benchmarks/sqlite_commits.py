@@ -0,0 +1,111 @@
+"""Compare committing every write against batched write transactions.
+
+Usage: python benchmarks/sqlite_commits.py [RESPONSES [TRACKS]]
+
+Stores RESPONSES simulated last.fm responses (20 by default) of TRACKS
+similar tracks each (250 by default) in a scratch database, the way
+Similarity.update_similar_tracks does: a track row and a match row for
+every similar track. First with a commit after every statement, the way
+the old database thread worked, then through autoqueue.database the way
+the service uses it, where the lookup after inserting a track only waits
+for that insert, and every response is committed once. Both use the
+journal mode and synchronous setting of autoqueue.database, so only the
+commits differ. Prints the commits, the time taken, and the statements
+and commits per second.
+"""
+from __future__ import division, print_function
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from timeit import default_timer
+
+from autoqueue.database import Database
+
+SCHEMA = (
+    'CREATE TABLE tracks (id INTEGER PRIMARY KEY, artist INTEGER, title '
+    'VARCHAR(100), updated DATE, UNIQUE(artist, title));',
+    'CREATE TABLE track_2_track (track1 INTEGER, track2 INTEGER, match '
+    'INTEGER, UNIQUE(track1, track2));')
+
+
+def statements(response, tracks):
+    """Yield (statement, priority, is_write) for one response.
+
+    The priorities are those Similarity uses for the same statements.
+
+    """
+    for number in range(tracks):
+        title = 'title %d %d' % (response, number)
+        yield (
+            'INSERT OR IGNORE INTO tracks (artist, title) VALUES (?, ?);',
+            (1, title)), 2, True
+        yield ('SELECT id FROM tracks WHERE artist = ? AND title = ?;',
+               (1, title)), 2, False
+        yield (
+            'INSERT INTO track_2_track (track1, track2, match) VALUES '
+            '(?, ?, ?);', (response, number, number % 100)), 10, True
+
+
+def every_statement(path, responses, tracks):
+    """Commit after every write, return the number of commits."""
+    connection = sqlite3.connect(path, isolation_level='immediate')
+    connection.execute('PRAGMA journal_mode = WAL;')
+    connection.execute('PRAGMA synchronous = NORMAL;')
+    for sql in SCHEMA:
+        connection.execute(sql)
+    commits = 0
+    for response in range(responses):
+        for sql, _, write in statements(response, tracks):
+            connection.execute(*sql).fetchall()
+            if write:
+                connection.commit()
+                commits += 1
+    connection.close()
+    return commits
+
+
+def batched(path, responses, tracks):
+    """Write through autoqueue.database, return the number of commits."""
+    database = Database(path)
+    for sql in SCHEMA:
+        database.execute((sql,), priority=0)
+    database.flush()
+    start = database.commits
+    for response in range(responses):
+        for sql, priority, write in statements(response, tracks):
+            if write:
+                database.execute(sql, priority=priority)
+            else:
+                database.select(sql, consistent=True, priority=priority)
+        database.flush()
+    return database.commits - start
+
+
+def main(argv):
+    responses = int(argv[0]) if argv else 20
+    tracks = int(argv[1]) if len(argv) > 1 else 250
+    writes = 2 * responses * tracks
+    directory = tempfile.mkdtemp()
+    try:
+        for name, function in (
+                ('every statement:', every_statement),
+                ('batched:', batched)):
+            start = default_timer()
+            commits = function(
+                os.path.join(directory, name[:-1].replace(' ', '_') + '.db'),
+                responses, tracks)
+            elapsed = default_timer() - start
+            print("%-17s %6d commits %8.2f s %10.0f writes/s %8.0f "
+                  "commits/s" % (
+                      name, commits, elapsed, writes / elapsed,
+                      commits / elapsed))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -54,6 +54,7 @@ rm -rf $RPM_BUILD_ROOT
 %doc COPYRIGHT.txt README.txt
 %{python_sitelib}/autoqueue*
 %{_libdir}/autoqueue/autoqueue-similarity-service
+%{_bindir}/autoqueue-analyze
 %{_datadir}/dbus-1/services/org.autoqueue.service
 
 %files -n quodlibet-autoqueue
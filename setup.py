@@ -20,8 +20,10 @@ setup(
     author_email='thisfred@gmail.com',
     url='https://launchpad.net/autoqueue',
     requires=[
-        'dateutil', 'pylast', 'pyowm', 'geohash', 'requests', 'nltk'],
+        'dateutil', 'pylast', 'pyowm', 'geohash', 'requests', 'nltk',
+        'numpy'],
     provides=['autoqueue'],
+    scripts=['bin/autoqueue-analyze'],
     data_files=[
         ('lib/autoqueue', ['bin/autoqueue-similarity-service']),
         ('share/dbus-1/services/', [SERVICE_FILE]),